@@ -18,47 +18,173 @@ Primary code for computing word error rate and other metrics from ASR output.
 """
 from __future__ import division
 
-from functools import reduce
-from collections import defaultdict
-from edit_distance import SequenceMatcher
+import io
+import mmap
+import multiprocessing
+import os
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from functools import lru_cache
+from itertools import product, zip_longest
+from operator import itemgetter
+
+import numpy as np
+from rapidfuzz.distance import Levenshtein
 
 from termcolor import colored
 
-# Some defaults
-print_instances_p = False
-print_errors_p = False
-files_head_ids = False
-files_tail_ids = False
-confusions = False
-min_count = 0
-wer_vs_length_p = True
-
-# For keeping track of the total number of tokens, errors, and matches
-ref_token_count = 0
-error_count = 0
-match_count = 0
-counter = 0
-sent_error_count = 0
-
-# For keeping track of word error rates by sentence length
-# this is so we can see if performance is better/worse for longer
-# and/or shorter sentences
-lengths = []
-error_rates = []
-wer_bins = defaultdict(list)
-wer_vs_length = defaultdict(list)
-# Tables for keeping track of which words get confused with one another
-insertion_table = defaultdict(int)
-deletion_table = defaultdict(int)
-substitution_table = defaultdict(int)
+# Ask termcolor once for the codes it would wrap a red token in, so the diff
+# renderer can color tokens with plain string concatenation.  Deriving the
+# codes from colored() preserves its NO_COLOR/tty detection.
+_RED_ON, _, _RED_OFF = colored('\0', 'red').partition('\0')
+
+
+@lru_cache(maxsize=1 << 16)
+def _red(text):
+    """Wrap a token in the ANSI codes for red.  Error words repeat a lot
+    across a corpus, so cache the wrapped strings."""
+    return _RED_ON + text + _RED_OFF
+
+@dataclass
+class EvalContext:
+    """The option flags and accumulated statistics for one evaluation.
+
+    Passing a context around explicitly, instead of mutating module globals,
+    lets each parallel worker accumulate into its own instance and merge the
+    results afterwards."""
+    # Options
+    print_instances_p: bool = False
+    print_errors_p: bool = False
+    files_head_ids: bool = False
+    files_tail_ids: bool = False
+    confusions: bool = False
+    min_count: int = 0
+    wer_vs_length_p: bool = True
+    # The total number of tokens, errors, matches, and sentences
+    ref_token_count: int = 0
+    error_count: int = 0
+    match_count: int = 0
+    counter: int = 0
+    sent_error_count: int = 0
+    # Word error rates by sentence length - this is so we can see if
+    # performance is better/worse for longer and/or shorter sentences
+    lengths: list = field(default_factory=list)
+    error_rates: list = field(default_factory=list)
+    wer_bins: dict = field(default_factory=lambda: defaultdict(list))
+    # Tables for keeping track of which words get confused with one another
+    insertion_table: Counter = field(default_factory=Counter)
+    deletion_table: Counter = field(default_factory=Counter)
+    substitution_table: Counter = field(default_factory=Counter)
+
+    @classmethod
+    def from_args(cls, args):
+        """Build a context from the parsed command line options."""
+        return cls(print_instances_p=args.print_instances,
+                   print_errors_p=args.print_errors,
+                   files_head_ids=args.head_ids,
+                   files_tail_ids=args.tail_ids,
+                   confusions=args.confusions,
+                   min_count=args.min_word_count,
+                   wer_vs_length_p=args.print_wer_vs_length)
+
+    def spawn(self):
+        """Return a fresh context with the same options and no statistics."""
+        return EvalContext(print_instances_p=self.print_instances_p,
+                           print_errors_p=self.print_errors_p,
+                           files_head_ids=self.files_head_ids,
+                           files_tail_ids=self.files_tail_ids,
+                           confusions=self.confusions,
+                           min_count=self.min_count,
+                           wer_vs_length_p=self.wer_vs_length_p)
+
+    def merge(self, other):
+        """Fold another context's statistics into this one."""
+        self.ref_token_count += other.ref_token_count
+        self.error_count += other.error_count
+        self.match_count += other.match_count
+        self.counter += other.counter
+        self.sent_error_count += other.sent_error_count
+        self.lengths.extend(other.lengths)
+        self.error_rates.extend(other.error_rates)
+        for length, rates in other.wer_bins.items():
+            self.wer_bins[length].extend(rates)
+        self.insertion_table.update(other.insertion_table)
+        self.deletion_table.update(other.deletion_table)
+        self.substitution_table.update(other.substitution_table)
+
+
 # These are the editdistance opcodes that are condsidered 'errors'
-error_codes = ['replace', 'delete', 'insert']
+error_codes = frozenset(('replace', 'delete', 'insert'))
+# The pool path uses the fork start method (the default everywhere but
+# Windows/macOS) for its cheap worker startup; everything a worker needs
+# travels in its pickled chunk.
+try:
+    _fork_context = multiprocessing.get_context('fork')
+except ValueError:
+    _fork_context = None
+# How many line pairs each pool task covers, and the minimum corpus size
+# before fanning out to the pool is worth the fork/pickle overhead.
+_POOL_CHUNK_PAIRS = 1000
+_POOL_MIN_PAIRS = 10000
+# Interned vocabulary mapping each word to a small integer.  Feeding integer
+# sequences to RapidFuzz keeps the comparisons on its bit-parallel fast path
+# rather than falling back to Python-level string comparisons.
+_vocab = {}
+
+
+def _encode(tokens):
+    """Intern a list of tokens into an array of small integer ids."""
+    return array('i', [_vocab.setdefault(t, len(_vocab)) for t in tokens])
+
+
+def _lower_line(line):
+    """Downcase a raw line of bytes.  bytes.lower handles only ASCII, so
+    lines containing anything else go through a proper Unicode round trip."""
+    if line.isascii():
+        return line.lower()
+    return line.decode('utf-8', 'replace').lower().encode('utf-8')
+
+
+def _iter_line_bytes(file_obj):
+    """Iterate over the lines of an open text file via a memory map,
+    yielding each line as raw bytes.
+
+    Memory-mapping skips the per-line buffered IO machinery and shares the
+    kernel page cache, which matters for large evaluation sets.  Falls back
+    to plain iteration for anything that can't be mapped (pipes, StringIO,
+    empty files)."""
+    try:
+        mm = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        for line in file_obj:
+            yield line.encode('utf-8')
+        return
+    try:
+        pos = 0
+        size = len(mm)
+        while pos < size:
+            newline = mm.find(b'\n', pos)
+            if newline == -1:
+                newline = size
+            yield mm[pos:newline]
+            pos = newline + 1
+    finally:
+        mm.close()
+
+
+def _iter_lines(file_obj):
+    """Iterate over the lines of an open text file via a memory map,
+    decoding each line.  Used by the paths that need string tokens."""
+    for line in _iter_line_bytes(file_obj):
+        yield line.decode('utf-8', 'replace')
 
 
 # TODO - rename this function.  Move some of it into evaluate.py?
 def main(args):
-    """Main method - this reads the hyp and ref files, and creates
-    editdistance.SequenceMatcher objects to compute the edit distance.
+    """Main method - this reads the hyp and ref files, and computes the edit
+    distance between each pair of lines with RapidFuzz.
     All the statistics necessary statistics are collected, and results are
     printed as specified by the command line options.
 
@@ -66,61 +192,65 @@ def main(args):
     hypothesis file have the same number of lines.  It will stop after the
     shortest one runs out of lines.  This should be easy to fix...
     """
-    global counter
-    set_global_variables(args)
-
-    counter = 0
-    # Loop through each line of the reference and hyp file
-    for ref_line, hyp_line in zip(args.ref, args.hyp):
-        processed_p = process_line_pair(ref_line, hyp_line, case_insensitive=args.case_insensitive,
-                                        remove_empty_refs=args.remove_empty_refs)
-        if processed_p:
-            counter += 1
-    if confusions:
-        print_confusions()
-    if wer_vs_length_p:
-        print_wer_vs_length()
+    ctx = EvalContext.from_args(args)
+
+    if ctx.print_instances_p or ctx.print_errors_p:
+        # Loop through each line of the reference and hyp file; the printed
+        # instances have to come out in file order
+        for ref_line, hyp_line in zip(_iter_lines(args.ref), _iter_lines(args.hyp)):
+            processed_p = process_line_pair(ctx, ref_line, hyp_line, case_insensitive=args.case_insensitive,
+                                            remove_empty_refs=args.remove_empty_refs)
+            if processed_p:
+                ctx.counter += 1
+    elif ctx.confusions:
+        # Confusion tracking needs the alignments but no per-line output, so
+        # the pairs can be processed in parallel chunks
+        process_chunked(ctx, args.ref, args.hyp, case_insensitive=args.case_insensitive,
+                        remove_empty_refs=args.remove_empty_refs)
+    else:
+        # Nothing downstream needs the alignments or per-line output, so the
+        # whole corpus can be processed as one batch.
+        process_batch(ctx, args.ref, args.hyp, case_insensitive=args.case_insensitive,
+                      remove_empty_refs=args.remove_empty_refs)
+    if ctx.confusions:
+        print_confusions(ctx)
+    if ctx.wer_vs_length_p:
+        print_wer_vs_length(ctx)
     # Compute WER and WRR
-    if ref_token_count > 0:
-        wrr = match_count / ref_token_count
-        wer = error_count / ref_token_count
+    if ctx.ref_token_count > 0:
+        wrr = ctx.match_count / ctx.ref_token_count
+        wer = ctx.error_count / ctx.ref_token_count
     else:
         wrr = 0.0
         wer = 0.0
     # Compute SER
-    if counter > 0:
-        ser = sent_error_count / counter
+    if ctx.counter > 0:
+        ser = ctx.sent_error_count / ctx.counter
     else:
         ser = 0.0
-    print('Sentence count: {}'.format(counter))
-    print('WER: {:10.3%} ({:10d} / {:10d})'.format(wer, error_count, ref_token_count))
-    print('WRR: {:10.3%} ({:10d} / {:10d})'.format(wrr, match_count, ref_token_count))
-    print('SER: {:10.3%} ({:10d} / {:10d})'.format(ser, sent_error_count, counter))
+    print('Sentence count: {}'.format(ctx.counter))
+    print('WER: {:10.3%} ({:10d} / {:10d})'.format(wer, ctx.error_count, ctx.ref_token_count))
+    print('WRR: {:10.3%} ({:10d} / {:10d})'.format(wrr, ctx.match_count, ctx.ref_token_count))
+    print('SER: {:10.3%} ({:10d} / {:10d})'.format(ser, ctx.sent_error_count, ctx.counter))
 
 
-def process_line_pair(ref_line, hyp_line, case_insensitive=False, remove_empty_refs=False):
+def process_line_pair(ctx, ref_line, hyp_line, case_insensitive=False, remove_empty_refs=False):
     """Given a pair of strings corresponding to a reference and hypothesis,
     compute the edit distance, print if desired, and keep track of results
-    in global variables.
+    in the given context.
 
     Return true if the pair was counted, false if the pair was not counted due
     to an empty reference string."""
-    # I don't believe these all need to be global.  In any case, they shouldn't be.
-    global error_count
-    global match_count
-    global ref_token_count
-    global sent_error_count
-
     # Split into tokens by whitespace
     ref = ref_line.split()
     hyp = hyp_line.split()
     id_ = None
 
     # If the files have IDs, then split the ID off from the text
-    if files_head_ids:
+    if ctx.files_head_ids:
         id_ = ref[0]
         ref, hyp = remove_head_id(ref, hyp)
-    elif files_tail_ids:
+    elif ctx.files_tail_ids:
         id_ = ref[-1]
         ref, hyp = remove_tail_id(ref, hyp)
 
@@ -130,57 +260,162 @@ def process_line_pair(ref_line, hyp_line, case_insensitive=False, remove_empty_r
     if remove_empty_refs and len(ref) == 0:
         return False
 
-    # Create an object to get the edit distance, and then retrieve the
-    # relevant counts that we need.
-    sm = SequenceMatcher(a=ref, b=hyp)
-    errors = get_error_count(sm)
-    matches = get_match_count(sm)
+    # Compute the alignment between the two sequences in C++ via RapidFuzz,
+    # and then retrieve the relevant counts that we need.  The alignment runs
+    # on the interned integer sequences; the original token lists are kept
+    # around for confusion tracking and diff printing.
+    need_alignment = ctx.confusions or ctx.print_instances_p or ctx.print_errors_p
+    if (len(ref) == 0 or len(hyp) == 0) and not need_alignment:
+        # If either side is empty, the length-difference lower bound on the
+        # edit distance is exact: every token on the non-empty side is an
+        # error and nothing matches, so skip the DP entirely.
+        opcodes = None
+        errors = len(ref) + len(hyp)
+        matches = 0
+    else:
+        opcodes = Levenshtein.opcodes(_encode(ref), _encode(hyp))
+        errors = get_error_count(opcodes)
+        matches = get_match_count(opcodes)
     ref_length = len(ref)
 
     # Increment the total counts we're tracking
-    error_count += errors
-    match_count += matches
-    ref_token_count += ref_length
+    ctx.error_count += errors
+    ctx.match_count += matches
+    ctx.ref_token_count += ref_length
 
     if errors != 0:
-        sent_error_count += 1
+        ctx.sent_error_count += 1
 
     # If we're keeping track of which words get mixed up with which others, call track_confusions
-    if confusions:
-        track_confusions(sm, ref, hyp)
+    if ctx.confusions:
+        track_confusions(ctx, opcodes, ref, hyp)
 
     # If we're printing instances, do it here (in roughly the align.c format)
-    if print_instances_p or (print_errors_p and errors != 0):
-        print_instances(ref, hyp, sm, id_=id_)
+    if ctx.print_instances_p or (ctx.print_errors_p and errors != 0):
+        print_instances(ctx, ref, hyp, opcodes, errors, matches, id_=id_,
+                        lowercased=case_insensitive)
 
     # Keep track of the individual error rates, and reference lengths, so we
     # can compute average WERs by sentence length
-    lengths.append(ref_length)
+    ctx.lengths.append(ref_length)
     if len(ref) > 0:
         error_rate = errors * 1.0 / len(ref)
     else:
         error_rate = float("inf")
-    error_rates.append(error_rate)
-    wer_bins[len(ref)].append(error_rate)
+    ctx.error_rates.append(error_rate)
+    ctx.wer_bins[len(ref)].append(error_rate)
     return True
 
-def set_global_variables(args):
-    """Copy argparse args into global variables."""
-    global print_instances_p
-    global print_errors_p
-    global files_head_ids
-    global files_tail_ids
-    global confusions
-    global min_count
-    global wer_vs_length_p
-    # Put the command line options into global variables.
-    print_instances_p = args.print_instances
-    print_errors_p = args.print_errors
-    files_head_ids = args.head_ids
-    files_tail_ids = args.tail_ids
-    confusions = args.confusions
-    min_count = args.min_word_count
-    wer_vs_length_p = args.print_wer_vs_length
+def _process_chunk(chunk):
+    """Process one chunk of line pairs in a pool worker and return a context
+    holding just that chunk's statistics."""
+    ctx, pairs, case_insensitive, remove_empty_refs = chunk
+    for ref_line, hyp_line in pairs:
+        if process_line_pair(ctx, ref_line, hyp_line, case_insensitive=case_insensitive,
+                             remove_empty_refs=remove_empty_refs):
+            ctx.counter += 1
+    return ctx
+
+def process_chunked(ctx, ref_file, hyp_file, case_insensitive=False, remove_empty_refs=False):
+    """Process the line pairs in chunks across a multiprocessing pool,
+    merging each worker's statistics into the given context.  Used for the
+    confusion path, where the Python-level table updates dominate.  Small
+    inputs (and platforms without fork) stay on the serial loop."""
+    pairs = list(zip(_iter_lines(ref_file), _iter_lines(hyp_file)))
+    if _fork_context is None or len(pairs) < _POOL_MIN_PAIRS:
+        for ref_line, hyp_line in pairs:
+            if process_line_pair(ctx, ref_line, hyp_line, case_insensitive=case_insensitive,
+                                 remove_empty_refs=remove_empty_refs):
+                ctx.counter += 1
+        return
+
+    chunks = [(ctx.spawn(), pairs[i:i + _POOL_CHUNK_PAIRS], case_insensitive, remove_empty_refs)
+              for i in range(0, len(pairs), _POOL_CHUNK_PAIRS)]
+    with _fork_context.Pool() as pool:
+        # Every statistic merges commutatively, so completion order is fine
+        for chunk_ctx in pool.imap_unordered(_process_chunk, chunks):
+            ctx.merge(chunk_ctx)
+
+# Test sets (and stress tests especially) repeat utterances verbatim, so
+# memoize the counts for short pairs and let duplicates hit the cache
+# instead of re-running the alignment.  Longer pairs aren't worth the tuple
+# conversion and cache space.
+_MEMO_MAX_TOKENS = 64
+
+
+def _pair_counts(ref, hyp):
+    """Return (errors, matches) for a single pair of encoded sequences."""
+    if len(ref) == 0 or len(hyp) == 0:
+        return len(ref) + len(hyp), 0
+    if len(ref) + len(hyp) <= _MEMO_MAX_TOKENS:
+        return _cached_pair_counts(tuple(ref), tuple(hyp))
+    return _compute_pair_counts(ref, hyp)
+
+@lru_cache(maxsize=1 << 18)
+def _cached_pair_counts(ref, hyp):
+    """_compute_pair_counts over hashable (tuple) sequences."""
+    return _compute_pair_counts(ref, hyp)
+
+def _compute_pair_counts(ref, hyp):
+    """A single editops call yields both counts: with unit weights the edit
+    distance equals the number of edit operations, and the matches are
+    whatever the matching blocks cover."""
+    editops = Levenshtein.editops(ref, hyp)
+    matches = sum(block[2] for block in editops.as_matching_blocks())
+    return len(editops), matches
+
+def process_batch(ctx, ref_file, hyp_file, case_insensitive=False, remove_empty_refs=False):
+    """Compute the corpus statistics for all line pairs in one batch, when
+    neither the alignments nor per-line output are needed.
+
+    The edit distances are computed across a thread pool - RapidFuzz releases
+    the GIL while it runs - and the per-sentence statistics are aggregated
+    with NumPy into the given context.
+
+    The tokens here exist only long enough to be interned, so the lines stay
+    as raw bytes: no per-line decode, and bytes tokens are far smaller than
+    str ones."""
+    refs = []
+    hyps = []
+    for ref_line, hyp_line in zip(_iter_line_bytes(ref_file), _iter_line_bytes(hyp_file)):
+        if case_insensitive:
+            # bytes.lower only folds ASCII, so take the decode hit for the
+            # occasional line that actually contains non-ASCII text
+            ref_line = _lower_line(ref_line)
+            hyp_line = _lower_line(hyp_line)
+        ref = ref_line.split()
+        hyp = hyp_line.split()
+        if ctx.files_head_ids:
+            ref, hyp = remove_head_id(ref, hyp)
+        elif ctx.files_tail_ids:
+            ref, hyp = remove_tail_id(ref, hyp)
+        if remove_empty_refs and len(ref) == 0:
+            continue
+        refs.append(_encode(ref))
+        hyps.append(_encode(hyp))
+
+    with ThreadPoolExecutor() as executor:
+        counts = list(executor.map(_pair_counts, refs, hyps))
+
+    lens = np.array([len(ref) for ref in refs], dtype=np.int64)
+    errs = np.array([count[0] for count in counts], dtype=np.int64)
+    ctx.ref_token_count += int(lens.sum())
+    ctx.error_count += int(errs.sum())
+    ctx.match_count += sum(count[1] for count in counts)
+    ctx.sent_error_count += int(np.count_nonzero(errs))
+
+    # Keep track of the individual error rates and reference lengths, so we
+    # can compute average WERs by sentence length.  Rather than appending to
+    # per-line Python lists, store the arrays themselves and bin the rates by
+    # length in one vectorized pass.
+    rates = np.where(lens > 0, errs / np.maximum(lens, 1), np.inf)
+    ctx.lengths = lens
+    ctx.error_rates = rates
+    uniq_lengths, inverse = np.unique(lens, return_inverse=True)
+    rate_sums = np.bincount(inverse, weights=rates)
+    rate_counts = np.bincount(inverse)
+    ctx.wer_bins = (uniq_lengths, rate_sums, rate_counts)
+    ctx.counter += len(refs)
 
 def remove_head_id(ref, hyp):
     """Assumes that the ID is the begin token of the string which is common
@@ -188,6 +423,10 @@ def remove_head_id(ref, hyp):
     ref_id = ref[0]
     hyp_id = hyp[0]
     if ref_id != hyp_id:
+        if isinstance(ref_id, bytes):
+            # The batch path works on raw bytes; decode for the message
+            ref_id = ref_id.decode('utf-8', 'replace')
+            hyp_id = hyp_id.decode('utf-8', 'replace')
         print('Reference and hypothesis IDs do not match! '
               'ref="{}" hyp="{}"\n'
               'File lines in hyp file should match those in the ref file.'.format(ref_id, hyp_id))
@@ -202,6 +441,10 @@ def remove_tail_id(ref, hyp):
     ref_id = ref[-1]
     hyp_id = hyp[-1]
     if ref_id != hyp_id:
+        if isinstance(ref_id, bytes):
+            # The batch path works on raw bytes; decode for the message
+            ref_id = ref_id.decode('utf-8', 'replace')
+            hyp_id = hyp_id.decode('utf-8', 'replace')
         print('Reference and hypothesis IDs do not match! '
               'ref="{}" hyp="{}"\n'
               'File lines in hyp file should match those in the ref file.'.format(ref_id, hyp_id))
@@ -210,164 +453,147 @@ def remove_tail_id(ref, hyp):
     hyp = hyp[:-1]
     return ref, hyp
 
-def print_instances(ref, hyp, sm, id_=None):
-    """Print a single instance of a ref/hyp pair."""
-    print_diff(sm, ref, hyp)
+def print_instances(ctx, ref, hyp, opcodes, errors, matches, id_=None, lowercased=False):
+    """Print a single instance of a ref/hyp pair.  lowercased says whether
+    the token lists are already downcased, saving print_diff the work."""
+    print_diff(opcodes, ref, hyp,
+               seq1_lower=ref if lowercased else None,
+               seq2_lower=hyp if lowercased else None)
     if id_:
-        print(('SENTENCE {0:d}  {1!s}'.format(counter + 1, id_)))
+        print(('SENTENCE {0:d}  {1!s}'.format(ctx.counter + 1, id_)))
     else:
-        print('SENTENCE {0:d}'.format(counter + 1))
+        print('SENTENCE {0:d}'.format(ctx.counter + 1))
     # Handle cases where the reference is empty without dying
     if len(ref) != 0:
-        correct_rate = sm.matches() / len(ref)
-        error_rate = sm.distance() / len(ref)
-    elif sm.matches() == 0:
+        correct_rate = matches / len(ref)
+        error_rate = errors / len(ref)
+    elif matches == 0:
         correct_rate = 1.0
         error_rate = 0.0
     else:
         correct_rate = 0.0
-        error_rate = sm.matches()
-    print('Correct          = {0:6.1%}  {1:3d}   ({2:6d})'.format(correct_rate, sm.matches(), len(ref)))
-    print('Errors           = {0:6.1%}  {1:3d}   ({2:6d})'.format(error_rate, sm.distance(), len(ref)))
+        error_rate = matches
+    print('Correct          = {0:6.1%}  {1:3d}   ({2:6d})'.format(correct_rate, matches, len(ref)))
+    print('Errors           = {0:6.1%}  {1:3d}   ({2:6d})'.format(error_rate, errors, len(ref)))
 
-def track_confusions(sm, seq1, seq2):
-    """Keep track of the errors in a global variable, given a sequence matcher."""
-    opcodes = sm.get_opcodes()
+def track_confusions(ctx, opcodes, seq1, seq2):
+    """Keep track of the errors in the context tables, given the opcodes of an alignment."""
     for tag, i1, i2, j1, j2 in opcodes:
         if tag == 'insert':
-            for i in range(j1, j2):
-                word = seq2[i]
-                insertion_table[word] += 1
+            ctx.insertion_table.update(seq2[j1:j2])
         elif tag == 'delete':
-            for i in range(i1, i2):
-                word = seq1[i]
-                deletion_table[word] += 1
+            ctx.deletion_table.update(seq1[i1:i2])
         elif tag == 'replace':
-            for w1 in seq1[i1:i2]:
-                for w2 in seq2[j1:j2]:
-                    key = (w1, w2)
-                    substitution_table[key] += 1
+            ctx.substitution_table.update(product(seq1[i1:i2], seq2[j1:j2]))
 
-def print_confusions():
+def print_confusions(ctx):
     """Print the confused words that we found... grouped by insertions, deletions
     and substitutions."""
-    if len(insertion_table) > 0:
+    if len(ctx.insertion_table) > 0:
         print('INSERTIONS:')
-        for item in sorted(list(insertion_table.items()), key=lambda x: x[1], reverse=True):
-            if item[1] >= min_count:
+        for item in ctx.insertion_table.most_common():
+            if item[1] >= ctx.min_count:
                 print('{0:20s} {1:10d}'.format(*item))
-    if len(deletion_table) > 0:
+    if len(ctx.deletion_table) > 0:
         print('DELETIONS:')
-        for item in sorted(list(deletion_table.items()), key=lambda x: x[1], reverse=True):
-            if item[1] >= min_count:
+        for item in ctx.deletion_table.most_common():
+            if item[1] >= ctx.min_count:
                 print('{0:20s} {1:10d}'.format(*item))
-    if len(substitution_table) > 0:
+    if len(ctx.substitution_table) > 0:
         print('SUBSTITUTIONS:')
-        for [w1, w2], count in sorted(list(substitution_table.items()), key=lambda x: x[1], reverse=True):
-            if count >= min_count:
+        for (w1, w2), count in ctx.substitution_table.most_common():
+            if count >= ctx.min_count:
                 print('{0:20s} -> {1:20s}   {2:10d}'.format(w1, w2, count))
 
-# TODO - For some reason I was getting two different counts depending on how I count the matches,
-# so do an assertion in this code to make sure we're getting matching counts.
-# This might slow things down.
-def get_match_count(sm):
-    "Return the number of matches, given a sequence matcher object."
-    matches = None
-    matches1 = sm.matches()
-    matching_blocks = sm.get_matching_blocks()
-    matches2 = reduce(lambda x, y: x + y, [x[2] for x in matching_blocks], 0)
-    assert matches1 == matches2
-    matches = matches1
+# The original code counted the matches two different ways and asserted that
+# they agreed, on every sentence.  Keep the cross-check available for
+# debugging behind an environment variable, but skip it in normal runs.
+def get_match_count(opcodes):
+    "Return the number of matches, given the opcodes of an alignment."
+    matches = sum(x[2] - x[1] for x in opcodes if x[0] == 'equal')
+    if __debug__ and os.environ.get('ASR_EVAL_CHECK'):
+        matching_blocks = opcodes.as_matching_blocks()
+        assert matches == sum(x[2] for x in matching_blocks)
     return matches
 
 
-def get_error_count(sm):
+def get_error_count(opcodes):
     """Return the number of errors (insertion, deletion, and substitutiions
-    , given a sequence matcher object."""
-    opcodes = sm.get_opcodes()
-    errors = [x for x in opcodes if x[0] in error_codes]
-    error_lengths = [max(x[2] - x[1], x[4] - x[3]) for x in errors]
-    return reduce(lambda x, y: x + y, error_lengths, 0)
-
-# TODO - This is long and ugly.  Perhaps we can break it up?
-# It would make more sense for this to just return the two strings...
-def print_diff(sm, seq1, seq2, prefix1='REF:', prefix2='HYP:', suffix1=None, suffix2=None):
-    """Given a sequence matcher and the two sequences, print a Sphinx-style
-    'diff' off the two."""
-    ref_tokens = []
-    hyp_tokens = []
-    opcodes = sm.get_opcodes()
+    , given the opcodes of an alignment."""
+    return sum(max(x[2] - x[1], x[4] - x[3]) for x in opcodes if x[0] in error_codes)
+
+def print_diff(opcodes, seq1, seq2, seq1_lower=None, seq2_lower=None,
+               prefix1='REF:', prefix2='HYP:', suffix1=None, suffix2=None):
+    """Given the opcodes of an alignment and the two sequences, print a
+    Sphinx-style 'diff' off the two.  The two lines are rendered in a single
+    pass over the opcodes, writing into a pair of string buffers.  Callers
+    holding already-downcased token lists can pass them as seq1_lower and
+    seq2_lower to skip the case folding here."""
+    # Case-fold each side once up front, rather than per matched token below
+    if seq1_lower is None:
+        seq1_lower = [token.lower() for token in seq1]
+    if seq2_lower is None:
+        seq2_lower = [token.lower() for token in seq2]
+    ref_buf = io.StringIO()
+    hyp_buf = io.StringIO()
+
+    def write_token(buf, token):
+        if buf.tell():
+            buf.write(' ')
+        buf.write(token)
+
+    if prefix1: write_token(ref_buf, prefix1)
+    if prefix2: write_token(hyp_buf, prefix2)
     for tag, i1, i2, j1, j2 in opcodes:
         # If they are equal, do nothing except lowercase them
         if tag == 'equal':
             for i in range(i1, i2):
-                ref_tokens.append(seq1[i].lower())
+                write_token(ref_buf, seq1_lower[i])
             for i in range(j1, j2):
-                hyp_tokens.append(seq2[i].lower())
+                write_token(hyp_buf, seq2_lower[i])
         # For insertions and deletions, put a filler of '***' on the other one, and
         # make the other all caps
         elif tag == 'delete':
             for i in range(i1, i2):
-                ref_token = colored(seq1[i].upper(), 'red')
-                ref_tokens.append(ref_token)
-            for i in range(i1, i2):
-                hyp_token = colored('*' * len(seq1[i]), 'red')
-                hyp_tokens.append(hyp_token)
+                write_token(ref_buf, _red(seq1[i].upper()))
+                write_token(hyp_buf, _red('*' * len(seq1[i])))
         elif tag == 'insert':
             for i in range(j1, j2):
-                ref_token = colored('*' * len(seq2[i]), 'red')
-                ref_tokens.append(ref_token)
-            for i in range(j1, j2):
-                hyp_token = colored(seq2[i].upper(), 'red')
-                hyp_tokens.append(hyp_token)
-        # More complicated logic for a substitution
+                write_token(ref_buf, _red('*' * len(seq2[i])))
+                write_token(hyp_buf, _red(seq2[i].upper()))
+        # For a substitution, pair up the words and pad the shorter of each
+        # pair (or the filler for an unpaired word) to the width of the longer
         elif tag == 'replace':
-            seq1_len = i2 - i1
-            seq2_len = j2 - j1
-            # Get a list of tokens for each
-            s1 = list(map(str.upper, seq1[i1:i2]))
-            s2 = list(map(str.upper, seq2[j1:j2]))
-            # Pad the two lists with False values to get them to the same length
-            if seq1_len > seq2_len:
-                for i in range(0, seq1_len - seq2_len):
-                    s2.append(False)
-            if seq1_len < seq2_len:
-                for i in range(0, seq2_len - seq1_len):
-                    s1.append(False)
-            assert len(s1) == len(s2)
-            # Pair up words with their substitutions, or fillers
-            for i in range(0, len(s1)):
-                w1 = s1[i]
-                w2 = s2[i]
-                # If we have two words, make them the same length
-                if w1 and w2:
-                    if len(w1) > len(w2):
-                        s2[i] = w2 + ' ' * (len(w1) - len(w2))
-                    elif len(w1) < len(w2):
-                        s1[i] = w1 + ' ' * (len(w2) - len(w1))
-                # Otherwise, create an empty filler word of the right width
-                if not w1:
-                    s1[i] = '*' * len(w2)
-                if not w2:
-                    s2[i] = '*' * len(w1)
-            s1 = map(lambda x: colored(x, 'red'), s1)
-            s2 = map(lambda x: colored(x, 'red'), s2)
-            ref_tokens += s1
-            hyp_tokens += s2
-    if prefix1: ref_tokens.insert(0, prefix1)
-    if prefix2: hyp_tokens.insert(0, prefix2)
-    if suffix1: ref_tokens.append(suffix1)
-    if suffix2: hyp_tokens.append(suffix2)
-    print(' '.join(ref_tokens))
-    print(' '.join(hyp_tokens))
+            s1 = map(str.upper, seq1[i1:i2])
+            s2 = map(str.upper, seq2[j1:j2])
+            for w1, w2 in zip_longest(s1, s2):
+                if w1 is None:
+                    w1 = '*' * len(w2)
+                elif w2 is None:
+                    w2 = '*' * len(w1)
+                else:
+                    width = max(len(w1), len(w2))
+                    w1 = w1.ljust(width)
+                    w2 = w2.ljust(width)
+                write_token(ref_buf, _red(w1))
+                write_token(hyp_buf, _red(w2))
+    if suffix1: write_token(ref_buf, suffix1)
+    if suffix2: write_token(hyp_buf, suffix2)
+    print(ref_buf.getvalue())
+    print(hyp_buf.getvalue())
 
 def mean(seq):
     """Return the average of the elements of a sequence."""
     return float(sum(seq)) / len(seq) if len(seq) > 0 else float('nan')
 
-def print_wer_vs_length():
+def print_wer_vs_length(ctx):
     """Print the average word error rate for each length sentence."""
-    avg_wers = {length: mean(wers) for length, wers in wer_bins.items()}
-    for length, avg_wer in sorted(avg_wers.items(), key=lambda x: (x[1], x[0])):
+    if isinstance(ctx.wer_bins, dict):
+        avg_wers = {length: mean(wers) for length, wers in ctx.wer_bins.items()}
+    else:
+        # The batch path stores per-length sums and counts as arrays
+        uniq_lengths, rate_sums, rate_counts = ctx.wer_bins
+        avg_wers = dict(zip(uniq_lengths.tolist(), (rate_sums / rate_counts).tolist()))
+    for length, avg_wer in sorted(avg_wers.items(), key=itemgetter(1, 0)):
         print('{0:5d} {1:f}'.format(length, avg_wer))
     print('')
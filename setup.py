@@ -8,7 +8,7 @@ setup(
     packages=['asr_evaluation'],
     license='LICENSE.txt',
     description='Evaluating ASR (automatic speech recognition) hypotheses, i.e. computing word error rate.',
-    install_requires=['edit_distance', 'termcolor'],
+    install_requires=['rapidfuzz', 'numpy', 'termcolor'],
     test_suite='test.test.TestASREvaluation',
     long_description=open('README.md').read(),
     long_description_content_type="text/markdown",